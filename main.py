@@ -4,29 +4,89 @@ import os
 import argparse
 from pyinaturalist import get_observation_species_counts
 import re
-import time
+import math
+import itertools
+import shutil
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from requests_cache import CachedSession
 from PIL import Image
 from io import BytesIO
 import concurrent.futures
-from threading import Lock
-from diskcache import Cache
+from collections import deque
+from functools import partial
+from threading import BoundedSemaphore, Lock
+from pyrate_limiter import Duration, Limiter, RequestRate
 
 root_folder = "fish_photos"  # Root folder where species folders will be created
 
 # Thread-safe counters
-request_count = 0
 species_done = 0
 total_results = 0
+folder_counts = {}  # Number of images in each species folder, scanned once then kept up to date
+seen_urls = set()  # Photo URLs already saved during this run
 lock = Lock()
-cache = Cache('cache', size_limit=1 * 1024 * 1024 * 1024)
+
+# Photo formats kept and the extension they are saved with, same as Pillow's format names
+image_extensions = {'image/jpeg': 'jpeg', 'image/png': 'png'}
+
+# Patterns used by to_snake_case, compiled once
+spaces_pattern = re.compile(r'\s+')
+camel_case_pattern = re.compile(r'([a-z])([A-Z])')
+
+# Token bucket shared by all threads to stay under the iNaturalist API limits (60 requests/min, 10k/day)
+# Photos are served by another host and do not go through it
+limiter = Limiter(RequestRate(60, Duration.MINUTE), RequestRate(10000, Duration.DAY))
+
+# Pool running the API calls, kept small since they are rate limited anyway
+api_pool = concurrent.futures.ThreadPoolExecutor(max_workers=4)
+# Pool downloading the photos from the CDN, shared by all the species
+download_pool = concurrent.futures.ThreadPoolExecutor(max_workers=30)
+# Maximum number of photo URLs waiting to be downloaded, observation pages are only fetched a few ahead of the downloads
+# so they do not pile up in memory
+download_slots = BoundedSemaphore(1000)
+# Maximum number of photos decoded and re-encoded by Pillow at the same time, the download threads mostly wait on the network
+convert_slots = BoundedSemaphore(4)
+
+adapter = HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=64,
+    max_retries=Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=['GET'])
+)
+
+# Shared HTTP sessions so connections to the API and the photo CDN are kept alive between requests
+# API responses are cached on disk by URL and params, honoring the ETag/Cache-Control headers
+# The sqlite cache runs in WAL mode, for which requests-cache sets synchronous=NORMAL: commits append to the WAL
+# without an fsync each, it is only synced at checkpoints. All threads still share one connection behind a lock
+session = CachedSession(
+    'inat_cache',
+    backend='sqlite',
+    wal=True,
+    expire_after=86400,
+    allowable_methods=['GET'],
+    cache_control=True
+)
+# Photos are never cached, a plain session skips the cache lookup on every download
+photo_session = requests.Session()
+for http_session in (session, photo_session):
+    http_session.mount('https://', adapter)
+    http_session.mount('http://', adapter)
+    http_session.headers.update({
+        'User-Agent': 'iNaturalistDatasetCreator',
+        'Accept-Encoding': 'gzip'
+    })
+
+# (connect, read) timeouts for the API, large result pages can take more than 10s to be returned
+api_timeout = (3.05, 30)
 
 def to_snake_case(string):
     # Replace spaces with underscores
-    string = re.sub(r'[\s]+', '_', string)
+    string = spaces_pattern.sub('_', string)
     
     # Convert camelCase or PascalCase to snake_case
-    string = re.sub(r'([a-z])([A-Z])', r'\1_\2', string)
+    string = camel_case_pattern.sub(r'\1_\2', string)
     
     # Convert all characters to lowercase
     string = string.lower()
@@ -35,152 +95,256 @@ def to_snake_case(string):
 
 def create_species_folder(root_folder, species_name):
     species_folder = os.path.join(root_folder, species_name)
-    if not os.path.exists(species_folder):
-        os.makedirs(species_folder)
+    os.makedirs(species_folder, exist_ok=True)
     return species_folder
 
-# Define a function to introduce a delay to respect the rate limit
-def respect_rate_limit():
-    global request_count
-    if request_count >= 60:
-        print("Rate limit reached, waiting for next minute...")
-        time.sleep(60)  # Wait for the next minute to avoid exceeding the limit
-        request_count = 0  # Reset the request count
-    else :
-        request_count += 1
+def count_images(folder):
+    # scandir entries carry their type, no extra stat per file
+    return sum(1 for entry in os.scandir(folder) if entry.is_file())
 
-def download_and_process_photo(photo_url, species_folder, photo_index):
-    try:
-        # Download the image
-        response = requests.get(photo_url)
-        if response.status_code == 200:
-            
-            # Ensure the content is actually an image
-            if 'image' not in response.headers['Content-Type']:
-                print(f"Skipping non-image URL: {photo_url}")
-                return  # Skip if it's not an image
-            img = Image.open(BytesIO(response.content))
-                        
-            # Check the image format before saving
-            if img.format not in ['JPEG', 'PNG']:
-                print(f"Skipping non-JPEG/PNG image: {photo_url}")
-                return  # Skip non-JPEG/PNG files
-            
-            # Check if image dimensions are valid (non-zero width/height)
-            if img.width == 0 or img.height == 0:
-                print(f"Skipping invalid image with zero dimensions: {photo_url}")
-                return  # Skip images with invalid dimensions
-
-            # Save the image with a unique name
-            photo_filename = f"{species_folder}/photo_{photo_index}.{img.format.lower()}"
-                        
-            if img.mode != 'RGB' and img.format == 'JPEG':
-                # Convert the image to RGB if it is a JPEG (other formats may need different handling)
-                img = img.convert('RGB')
-            
-            img.save(photo_filename)
-
-            # print(f"Downloaded and saved {photo_filename}")
-        else:
+def get_image_count(folder):
+    # The folder is only scanned the first time it is seen, downloads keep the count up to date afterwards
+    if folder not in folder_counts:
+        num_images = count_images(folder)
+        with lock:
+            folder_counts.setdefault(folder, num_images)
+    return folder_counts[folder]
+
+def record_saved_photo(photo_url, folder, new_file):
+    # Called by the download threads once a photo is saved
+    with lock:
+        seen_urls.add(photo_url)
+        if new_file:
+            folder_counts[folder] += 1
+
+def write_photo(photo_filename, data):
+    # Unbuffered file written straight from the downloaded body, without copying it in chunks
+    with data.getbuffer() as buffer, open(photo_filename, 'wb', buffering=0) as f:
+        # FileIO.write may write only part of the buffer (e.g. disk full), keep going until it is all written
+        written = 0
+        while written < len(buffer):
+            written += f.write(buffer[written:])
+        try:
+            # The photos are not read back, don't let them fill the page cache (Linux only)
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+        except AttributeError:
+            pass
+
+def is_rgb_jpeg(data):
+    # Checks the SOI/EOI markers and reads the frame header without going through Pillow
+    # True for a complete JPEG with 3 components (what Pillow opens as RGB) and non-zero dimensions
+    if data[:2] != b'\xff\xd8' or data[-2:] != b'\xff\xd9':
+        return False
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            return False
+        marker = data[i + 1]
+        if marker == 0xFF:
+            # Fill byte before a marker
+            i += 1
+            continue
+        # Start of frame markers, DHT (C4), JPG (C8) and DAC (CC) share the same range
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height = int.from_bytes(data[i + 5:i + 7], 'big')
+            width = int.from_bytes(data[i + 7:i + 9], 'big')
+            return data[i + 9] == 3 and width > 0 and height > 0
+        # Skip the segment, its length includes the two length bytes
+        i += 2 + int.from_bytes(data[i + 2:i + 4], 'big')
+    return False
+
+def download_and_process_photo(photo_url, photo_index, *, species_folder):
+    # Download the image, streaming the body so it is only held once in memory
+    with photo_session.get(photo_url, stream=True, timeout=(5, 30)) as response:
+        if response.status_code != 200:
             print(f"Failed to download image: {photo_url}")
-    except Exception as e:
-        print(f"Error downloading image {photo_url}: {e}")
+            return
+
+        # Pick the file extension from the Content-Type, before reading the body
+        content_type = response.headers.get('Content-Type', '').split(';')[0].strip()
+        extension = image_extensions.get(content_type)
+        if not extension:
+            print(f"Skipping non-JPEG/PNG URL: {photo_url}")
+            return  # Skip if it's not a JPEG/PNG image
 
-def get_observations(taxon_id, quality_grade, order_by, photos, per_page):
+        # Save the image with a unique name
+        photo_filename = f"{species_folder}/photo_{photo_index}.{extension}"
+
+        response.raw.decode_content = True
+        data = BytesIO()
+        shutil.copyfileobj(response.raw, data)
+
+    new_file = not os.path.exists(photo_filename)
+
+    with data.getbuffer() as buffer:
+        rgb_jpeg = extension == 'jpeg' and is_rgb_jpeg(buffer)
+    if rgb_jpeg:
+        # Complete RGB JPEG, nothing for Pillow to check or convert
+        write_photo(photo_filename, data)
+        record_saved_photo(photo_url, species_folder, new_file)
+        return
+
+    # Image.open only parses the header, the pixels are decoded lazily
+    data.seek(0)
+    img = Image.open(data)
+
+    # Check the image format matches the Content-Type before saving
+    if img.format.lower() != extension:
+        print(f"Skipping image not matching its Content-Type: {photo_url}")
+        return  # Skip mislabeled files
+
+    # Check if image dimensions are valid (non-zero width/height)
+    if img.width == 0 or img.height == 0:
+        print(f"Skipping invalid image with zero dimensions: {photo_url}")
+        return  # Skip images with invalid dimensions
+
+    if img.format == 'JPEG' and img.mode != 'RGB':
+        # Convert the image to RGB if it is a JPEG (other formats may need different handling)
+        with convert_slots:
+            img.convert('RGB').save(photo_filename)
+        record_saved_photo(photo_url, species_folder, new_file)
+        return
+
+    # Not a complete RGB JPEG, decode it so truncated or corrupt files raise instead of being saved
+    with convert_slots:
+        img.load()
+
+    # Nothing to convert, write the downloaded bytes as is instead of re-encoding them
+    write_photo(photo_filename, data)
+
+    # print(f"Downloaded and saved {photo_filename}")
+    record_saved_photo(photo_url, species_folder, new_file)
+
+def api_get(url, params, **kwargs):
+    # Cached responses are served without taking a token from the rate limiter
+    r = session.get(url=url, params=params, only_if_cached=True)
+    if r.status_code == 504:
+        with limiter.ratelimit('inat', delay=True):
+            r = session.get(url=url, params=params, **kwargs)
+    # orjson parses the large observation payloads much faster than the json module
+    return orjson.loads(r.content)
+
+def get_observations(taxon_id, quality_grade, order_by, photos, per_page, page=1):
     params = {
         'taxon_id': taxon_id,
         'order_by': order_by,
         'quality_grade': quality_grade,
         'photo_license': 'any',
         'photos': photos,
-        'page' : '',
+        'page' : page,
         'per_page': per_page 
     }
     try :
-        r = requests.get(url="https://api.inaturalist.org/v1/observations", params=params, timeout=5)
-        return r.json()
+        return api_get(url="https://api.inaturalist.org/v1/observations", params=params, timeout=api_timeout)
     except requests.exceptions.RequestException as e :
         raise e
     
+def iter_observations(taxon_id, quality_grade, order_by, photos, target):
+    if target <= 0:
+        return
+
+    # The API returns at most 200 observations per page and 10k results per query
+    per_page = min(200, target)
+    first_page = api_pool.submit(get_observations, taxon_id=taxon_id, quality_grade=quality_grade, order_by=order_by, photos=photos, per_page=per_page, page=1).result()
+    target = min(target, first_page['total_results'], 10000)
+    yield from first_page['results'][:target]
+
+    nb_pages = math.ceil(target / per_page)
+    if nb_pages < 2:
+        return
+
+    # Fetch the following pages on the API pool, at most 3 ahead of the one being consumed
+    # The rate limiter still paces the requests
+    remaining = target - len(first_page['results'])
+    fetch_page = partial(get_observations, taxon_id=taxon_id, quality_grade=quality_grade, order_by=order_by, photos=photos, per_page=per_page)
+    next_pages = iter(range(2, nb_pages + 1))
+    pages = deque(api_pool.submit(fetch_page, page=page) for page in itertools.islice(next_pages, 3))
+    try:
+        while pages:
+            page = pages.popleft().result()
+            next_page = next(next_pages, None)
+            if next_page is not None:
+                pages.append(api_pool.submit(fetch_page, page=next_page))
+
+            results = page['results'][:remaining]
+            yield from results
+            remaining -= len(results)
+            if remaining <= 0 or len(page['results']) < per_page:
+                return
+    finally:
+        # Drop the pages not fetched yet if we stopped early
+        for page in pages:
+            page.cancel()
+
 def search_specy(query):
     params = {
        'q' : query
     }
     try :
-        r = requests.get(url="https://api.inaturalist.org/v1/search", params=params)
-        return r.json()
+        return api_get(url="https://api.inaturalist.org/v1/search", params=params, timeout=api_timeout)
     except requests.exceptions.RequestException as e :
         raise e
     
 
-def cached_get_observations(taxon_id, quality_grade, order_by, photos, per_page, species_folder):
-    cache_key = species_folder 
-    if cache_key in cache:
-        print(f"Cache used for {species_folder}")
-        return cache[cache_key]
-    else :
-        lock.acquire()
-        respect_rate_limit()
-        lock.release()
-      
-        res = get_observations(taxon_id=taxon_id, quality_grade=quality_grade, order_by=order_by, photos=photos, per_page=per_page)
-        cache[cache_key] = res
-        return res
-
 def process_specy(specy, nb_img):
-    global request_count, species_done
+    global species_done
     
     common_name = to_snake_case(specy['taxon']['name'])
-    species_folder = os.path.join(root_folder, common_name)
-    
-    if os.path.exists(species_folder) :
-        num_images = len([name for name in os.listdir(species_folder) if os.path.isfile(os.path.join(species_folder, name))])
-        
-        if num_images >= 30 :
-            with lock:
-                species_done += 1
-                # print("🫵 Already found ", common_name)     
-                # report_stats()
-            return
-
     species_folder = create_species_folder(root_folder, common_name)
-    
-    # print(f"Getting observations for {common_name}")
-    obs = cached_get_observations(taxon_id=specy['taxon']['id'], quality_grade="research", order_by="votes", photos=True, per_page=nb_img, species_folder=species_folder)
-    total_results = obs['total_results']
-    obs = obs['results']
-    # print("Observations fetched for ", common_name, " !")
-    
-    photo_urls = []
-    for anObs in obs :
-        if anObs['observation_photos']: 
-            photoUrl = anObs['observation_photos'][0]['photo']['url']
-            mediumPhotoUrl = re.sub(r'square', 'medium', photoUrl, count=1)
-            photo_urls.append(mediumPhotoUrl)
-        
-    num_images = len([name for name in os.listdir(species_folder) if os.path.isfile(os.path.join(species_folder, name))])
-    if num_images < 100 and num_images < total_results:
-        # Download photos in parallel with ThreadPoolExecutor
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            executor.map(lambda url: download_and_process_photo(url[1], species_folder, url[0]), enumerate(photo_urls))
+    num_images = get_image_count(species_folder)
+
+    if num_images >= 30 :
+        with lock:
+            species_done += 1
+            # print("🫵 Already found ", common_name)     
+            # report_stats()
+        return
+
+    if num_images < nb_img:
+        # print(f"Getting observations for {common_name}")
+        observations = iter_observations(taxon_id=specy['taxon']['id'], quality_grade="research", order_by="votes", photos=True, target=nb_img)
+        photo_urls = (
+            anObs['observation_photos'][0]['photo']['url'].replace('square', 'medium', 1)
+            for anObs in observations if anObs['observation_photos']
+        )
+
+        # Download photos on the shared pool as soon as each page of observations arrives
+        download = partial(download_and_process_photo, species_folder=species_folder)
+        futures = {}
+        species_urls = set()
+        for photo_url in photo_urls:
+            # Skip the photos returned twice for this species or already saved for another one
+            if photo_url in species_urls or photo_url in seen_urls:
+                continue
+            photo_index = len(species_urls)
+            species_urls.add(photo_url)
+
+            download_slots.acquire()
+            future = download_pool.submit(download, photo_url, photo_index)
+            future.add_done_callback(lambda _: download_slots.release())
+            futures[future] = photo_url
+
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                print(f"Error downloading image {futures[future]}: {e}")
     
     with lock:
         species_done += 1
-        
-    num_images = len([name for name in os.listdir(species_folder) if os.path.isfile(os.path.join(species_folder, name))])
+        num_images = folder_counts[species_folder]
         
     print(f"🐟 Done specy: {common_name} with {num_images} images")
     report_stats()
 
 def report_stats():
-    global request_count, species_done, total_results
-    print(f"Total requests made: {request_count}")
-    print(f"Runtime progress : {(species_done / total_results) * 100 }%")
+    with lock:
+        progress = species_done / max(total_results, 1) * 100
+    print(f"Runtime progress : {progress}%")
     
-def process_indian_oceanic_fish_species(nb_img):
-    page = 1
-    per_page = 500  # Maximum number of results per page
-    observations = get_observation_species_counts(
+@limiter.ratelimit('inat', delay=True)
+def get_species_counts(page, per_page):
+    return get_observation_species_counts(
         lat=-15.760536148501288,
         lng=77.64325073204107,
         radius=4054.037977613122,
@@ -191,33 +355,37 @@ def process_indian_oceanic_fish_species(nb_img):
         per_page=per_page,
         page=page
     )
+
+def process_indian_oceanic_fish_species(nb_img):
+    global total_results
+    per_page = 500  # Maximum number of results per page
+    observations = get_species_counts(page=1, per_page=per_page)
     
-    total_results = observations['total_results']
-    print(f'Total species to process: {total_results}')
-    
-    all_species = observations['results']
-    
-    # Loop through pages to get all results
-    while len(all_species) < total_results:
-        page += 1
-        observations = get_observation_species_counts(
-            lat=-15.760536148501288,
-            lng=77.64325073204107,
-            radius=4054.037977613122,
-            iconic_taxa="Actinopterygii",
-            captive=False,
-            spam=False,
-            verifiable=True,
-            per_page=per_page,
-            page=page
-        )
-        all_species.extend(observations['results'])
+    nb_species = observations['total_results']
+    print(f'Total species to process: {nb_species}')
+    with lock:
+        total_results = nb_species
     
-    print(f'Total species fetched: {len(all_species)}')
+    # The first page gives the number of pages, fetch all the others at once
+    nb_pages = math.ceil(nb_species / per_page)
+    pages = [api_pool.submit(get_species_counts, page=page, per_page=per_page) for page in range(2, nb_pages + 1)]
     
-    # Process species in parallel using ThreadPoolExecutor
+    # Process species in parallel using ThreadPoolExecutor, the API calls and downloads run on their own pools
+    # Species of the first page start while the other pages are fetched
     with concurrent.futures.ThreadPoolExecutor(max_workers=20) as executor:
-        executor.map(process_specy, all_species, [nb_img] * len(all_species))
+        all_species = observations['results']
+        for specy in all_species:
+            executor.submit(process_specy, specy, nb_img)
+        
+        for page in concurrent.futures.as_completed(pages):
+            results = page.result()['results']
+            all_species.extend(results)
+            for specy in results:
+                executor.submit(process_specy, specy, nb_img)
+        
+        print(f'Total species fetched: {len(all_species)}')
+        with lock:
+            total_results = len(all_species)
 
 if __name__ == "__main__":  
     parser = argparse.ArgumentParser(description="Scrape fish photos from iNaturalist")
@@ -228,6 +396,7 @@ if __name__ == "__main__":
     if args.species:
         # TODO: fetch the specy from scientific name
         taxonNameList = args.species.split(",")
+        total_results = len(taxonNameList)
         for taxonName in taxonNameList:
             r = search_specy(taxonName)
             if r['total_results'] > 0: